@@ -1,19 +1,79 @@
-from flask import Flask, request, jsonify
+# Patch blocking I/O for gevent before requests/google-cloud are imported
+from gevent import monkey
+monkey.patch_all()
+
+# gRPC (BigQuery Storage Write API, Gemini) needs to cooperate with the gevent loop
+import grpc.experimental.gevent as grpc_gevent
+grpc_gevent.init_gevent()
+
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 import os
 import json
-from shopify_to_bigquery import run_pipeline
-from gemini_integration import analyze_data
+from shopify_to_bigquery import run_pipeline, get_bigquery_client, fetch_context
+from gemini_integration import analyze_data, analyze_data_stream
 import logging
+import collections
+import threading
 import time
+import uuid
+import orjson
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+class RingHandler(logging.Handler):
+    """Logging handler that keeps the most recent formatted records in memory."""
+
+    def __init__(self, capacity=500):
+        super().__init__()
+        self.buf = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.buf.append(self.format(record))
+
+# Capture logs from every module for the /api/logs endpoint
+RING_HANDLER = RingHandler()
+RING_HANDLER.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+logging.getLogger().addHandler(RING_HANDLER)
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider that serializes with orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app)
 
+STREAM_BATCH_SIZE = 100  # Rows serialized per chunk when streaming job results
+
+# Pipeline runs keyed by job ID, oldest first; kept in process memory, so a multi-process
+# deployment needs a shared store such as Redis instead
+JOBS = collections.OrderedDict()
+# Running job ID per (project, dataset), so only one run at a time writes to a dataset's tables
+RUNNING_JOBS = {}
+JOBS_LOCK = threading.Lock()
+JOB_TTL = 3600  # Seconds a finished job and its rows are kept for polling
+MAX_JOBS = 20  # Finished jobs kept at most; running jobs are never evicted
+
+def prune_jobs():
+    """Evict finished jobs past JOB_TTL, then the oldest finished jobs beyond MAX_JOBS. Call with JOBS_LOCK held."""
+    now = time.time()
+    finished = [job_id for job_id, job in JOBS.items() if job["status"] != "running"]
+    for job_id in finished:
+        if now - JOBS[job_id]["finishedAt"] > JOB_TTL:
+            del JOBS[job_id]
+    finished = [job_id for job_id in finished if job_id in JOBS]
+    for job_id in finished[:max(0, len(finished) - MAX_JOBS)]:
+        del JOBS[job_id]
+
 @app.route('/api/connectors/shopify', methods=['POST'])
 def connect_shopify():
     try:
@@ -81,9 +141,33 @@ def run_pipeline_endpoint():
         data = request.json
         pipeline_id = data.get('pipelineId') if data else None
         
-        logger.info(f"Running pipeline {pipeline_id if pipeline_id else 'all'}")
+        # Run the pipeline in the background and let the client poll for the result; a run already
+        # in progress for the same dataset is returned instead of starting a second one
+        target = (gcp_project_id, dataset_id)
+        with JOBS_LOCK:
+            prune_jobs()
+            running_job_id = RUNNING_JOBS.get(target)
+            if running_job_id:
+                logger.info(f"Pipeline already running for {gcp_project_id}.{dataset_id} as job {running_job_id}")
+                return jsonify({"success": True, "message": "Pipeline already running", "jobId": running_job_id}), 202
+            job_id = uuid.uuid4().hex
+            JOBS[job_id] = {"status": "running", "pipelineId": pipeline_id}
+            RUNNING_JOBS[target] = job_id
+        threading.Thread(
+            target=run_pipeline_job,
+            args=(job_id, shopify_shop_name, shopify_api_token, gcp_project_id, credentials_path, dataset_id),
+            daemon=True
+        ).start()
         
-        # Run the pipeline
+        logger.info(f"Started pipeline {pipeline_id if pipeline_id else 'all'} as job {job_id}")
+        return jsonify({"success": True, "message": "Pipeline started", "jobId": job_id}), 202
+    except Exception as e:
+        logger.error(f"Pipeline failed: {str(e)}")
+        return jsonify({"success": False, "message": f"Pipeline failed: {str(e)}"}), 500
+
+def run_pipeline_job(job_id, shopify_shop_name, shopify_api_token, gcp_project_id, credentials_path, dataset_id):
+    """Run the pipeline for a background job and record its outcome in JOBS."""
+    try:
         customers_data, products_data = run_pipeline(
             shopify_shop_name,
             shopify_api_token,
@@ -91,16 +175,63 @@ def run_pipeline_endpoint():
             credentials_path,
             dataset_id
         )
-        
-        return jsonify({
-            "success": True,
+        outcome = {
+            "status": "completed",
             "message": "Pipeline executed successfully",
             "customers": customers_data,
             "products": products_data
-        })
+        }
     except Exception as e:
-        logger.error(f"Pipeline failed: {str(e)}")
-        return jsonify({"success": False, "message": f"Pipeline failed: {str(e)}"}), 500
+        logger.error(f"Pipeline job {job_id} failed: {str(e)}")
+        outcome = {"status": "failed", "message": f"Pipeline failed: {str(e)}"}
+    with JOBS_LOCK:
+        JOBS[job_id].update(outcome, finishedAt=time.time())
+        RUNNING_JOBS.pop((gcp_project_id, dataset_id), None)
+
+def job_result_chunks(job_id, job):
+    """Serialize a completed job as JSON in chunks, so the rows are never encoded into one body."""
+    summary = {key: value for key, value in job.items() if key not in ('customers', 'products')}
+    yield app.json.dumps({"success": True, "jobId": job_id, **summary})[:-1]
+    for key in ('customers', 'products'):
+        rows = job.get(key, [])
+        yield f', "{key}": ['
+        for start in range(0, len(rows), STREAM_BATCH_SIZE):
+            prefix = ',' if start else ''
+            yield prefix + app.json.dumps(rows[start:start + STREAM_BATCH_SIZE])[1:-1]
+        yield ']'
+    yield '}'
+
+@app.route('/api/pipelines/status/<job_id>', methods=['GET'])
+def pipeline_status(job_id):
+    with JOBS_LOCK:
+        prune_jobs()
+        job = JOBS.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "message": f"Unknown pipeline job: {job_id}"}), 404
+    if job["status"] == "completed":
+        return Response(stream_with_context(job_result_chunks(job_id, job)), mimetype='application/json')
+    return jsonify({"success": job["status"] != "failed", "jobId": job_id, **job})
+
+def get_data_context():
+    """Fetch a small sample of BigQuery data to give Gemini context, or None if BigQuery isn't connected."""
+    gcp_project_id = os.getenv('GCP_PROJECT_ID')
+    credentials_path = os.getenv('GOOGLE_CREDENTIALS_PATH')
+    dataset_id = os.getenv('BIGQUERY_DATASET_ID', 'shopify_data')
+    
+    if all([gcp_project_id, credentials_path]):
+        try:
+            # Read a few rows already loaded into BigQuery for context
+            client = get_bigquery_client(credentials_path, gcp_project_id)
+            return fetch_context(client, gcp_project_id, dataset_id, limit=10)
+        except Exception as e:
+            logger.warning(f"Could not fetch data for Gemini context: {e}")
+    return None
+
+def sse_event(text, event=None):
+    """Format text as a server-sent event, splitting multi-line text across data fields."""
+    lines = [f"event: {event}"] if event else []
+    lines += [f"data: {line}" for line in text.split('\n')]
+    return '\n'.join(lines) + '\n\n'
 
 @app.route('/api/gemini/analyze', methods=['POST'])
 def analyze_with_gemini():
@@ -120,28 +251,7 @@ def analyze_with_gemini():
             }), 400
         
         # Get data context if available
-        shopify_shop_name = os.getenv('SHOPIFY_SHOP_NAME')
-        gcp_project_id = os.getenv('GCP_PROJECT_ID')
-        credentials_path = os.getenv('GOOGLE_CREDENTIALS_PATH')
-        dataset_id = os.getenv('BIGQUERY_DATASET_ID', 'shopify_data')
-        
-        data_context = None
-        if all([shopify_shop_name, gcp_project_id, credentials_path]):
-            try:
-                # Try to get some data for context
-                customers_data, products_data = run_pipeline(
-                    shopify_shop_name,
-                    os.getenv('SHOPIFY_API_TOKEN'),
-                    gcp_project_id,
-                    credentials_path,
-                    dataset_id
-                )
-                data_context = {
-                    "customers": customers_data[:10],  # Limit to 10 items for context
-                    "products": products_data[:10]
-                }
-            except Exception as e:
-                logger.warning(f"Could not fetch data for Gemini context: {e}")
+        data_context = get_data_context()
         
         # Analyze with Gemini
         response = analyze_data(prompt, data_context)
@@ -152,23 +262,42 @@ def analyze_with_gemini():
         logger.error(f"Gemini analysis failed: {str(e)}")
         return jsonify({"success": False, "message": f"Analysis failed: {str(e)}"}), 500
 
+@app.route('/api/gemini/analyze/stream', methods=['GET', 'POST'])
+def analyze_with_gemini_stream():
+    """Stream a Gemini analysis as server-sent events; GET takes the prompt as a query parameter for EventSource."""
+    try:
+        data = request.get_json(silent=True) or request.args
+        prompt = data.get('prompt')
+        
+        if not prompt:
+            return jsonify({"success": False, "message": "Prompt is required."}), 400
+        
+        # Check if Gemini API key is set
+        if not os.getenv('GEMINI_API_KEY'):
+            return jsonify({
+                "success": False, 
+                "message": "Gemini API key not configured. Please set the GEMINI_API_KEY environment variable."
+            }), 400
+        
+        data_context = get_data_context()
+        
+        def generate():
+            for text in analyze_data_stream(prompt, data_context):
+                yield sse_event(text)
+            yield sse_event('', event='done')
+        
+        logger.info(f"Streaming Gemini analysis for prompt: {prompt[:50]}...")
+        return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+    except Exception as e:
+        logger.error(f"Gemini analysis failed: {str(e)}")
+        return jsonify({"success": False, "message": f"Analysis failed: {str(e)}"}), 500
+
 @app.route('/api/logs', methods=['GET'])
 def get_logs():
     """Return recent logs for the frontend."""
     try:
-        # In a real app, you would fetch logs from a log file or database
-        # For now, we'll return mock logs
-        mock_logs = [
-            f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] INFO: API server started",
-            f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - 60))}] INFO: Connected to Shopify API",
-            f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - 120))}] INFO: Connected to BigQuery",
-            f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - 180))}] INFO: Pipeline execution started",
-            f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - 240))}] INFO: Fetched 250 customer records",
-            f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - 300))}] INFO: Inserted data into BigQuery",
-            f"[{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - 360))}] INFO: Pipeline execution completed"
-        ]
-        
-        return jsonify({"success": True, "logs": mock_logs})
+        return jsonify({"success": True, "logs": list(RING_HANDLER.buf)})
     except Exception as e:
         logger.error(f"Failed to fetch logs: {str(e)}")
         return jsonify({"success": False, "message": f"Failed to fetch logs: {str(e)}"}), 500
@@ -1,58 +1,137 @@
 import os
+import functools
+import hashlib
 import google.generativeai as genai
 import logging
+import orjson
+import redis
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+GEMINI_CACHE_TTL = 3600  # Seconds a cached Gemini response is kept
+REDIS_TIMEOUT = 0.2  # Seconds to wait on Redis before skipping the cache
+
+# Redis cache for Gemini responses; the connection is opened lazily on first use, and short
+# timeouts make an unreachable Redis fall through to Gemini instead of stalling the request
+_REDIS = redis.Redis.from_url(
+    os.getenv('REDIS_URL', 'redis://localhost'),
+    socket_connect_timeout=REDIS_TIMEOUT,
+    socket_timeout=REDIS_TIMEOUT
+)
+
+def _get_cached_response(key):
+    """Return a cached Gemini response, or None if it is missing or Redis is unavailable."""
+    try:
+        cached = _REDIS.get(key)
+        return cached.decode() if cached else None
+    except redis.RedisError as e:
+        logger.warning(f"Failed to read Gemini response cache: {e}")
+        return None
+
+def _cache_response(key, text):
+    """Cache a Gemini response, ignoring Redis errors."""
+    try:
+        _REDIS.setex(key, GEMINI_CACHE_TTL, text)
+    except redis.RedisError as e:
+        logger.warning(f"Failed to write Gemini response cache: {e}")
+
+@functools.lru_cache(maxsize=4)
+def _get_model(api_key):
+    """Configure the Gemini API and build the model once per API key."""
+    genai.configure(api_key=api_key)
+    logger.info("Gemini API initialized successfully")
+    return genai.GenerativeModel('gemini-pro')
+
 def initialize_gemini():
-    """Initialize the Gemini API client."""
+    """Initialize the Gemini API client and return the model, reusing it across requests."""
     try:
         api_key = os.getenv('GEMINI_API_KEY')
         if not api_key:
             logger.error("GEMINI_API_KEY environment variable not set")
             return None
             
-        genai.configure(api_key=api_key)
-        logger.info("Gemini API initialized successfully")
-        return True
+        return _get_model(api_key)
     except Exception as e:
         logger.error(f"Failed to initialize Gemini API: {e}")
         return None
 
+def _build_prompt(prompt, data=None):
+    """Combine the data context and the user's prompt into the full Gemini prompt."""
+    # Prepare context with data if provided
+    context = ""
+    if data:
+        if isinstance(data, dict):
+            context = "Data context:\n"
+            for key, value in data.items():
+                if isinstance(value, list) and len(value) > 0:
+                    context += f"\n{key} (showing first 5 items):\n"
+                    context += orjson.dumps(value[:5], default=str).decode()[:2000] + "\n"
+                else:
+                    context += f"\n{key}: {value}\n"
+        else:
+            context = f"Data context:\n{str(data)[:1000]}...\n\n"
+    
+    # Combine context and prompt
+    return f"{context}\n\nBased on the above data, {prompt}"
+
+def _cache_key(full_prompt):
+    """Build the Redis key for a full prompt, which already embeds the data context."""
+    return 'gemini:' + hashlib.sha256(full_prompt.encode()).hexdigest()
+
 def analyze_data(prompt, data=None):
     """Analyze data using Gemini API."""
     try:
-        if not initialize_gemini():
+        model = initialize_gemini()
+        if not model:
             return "Error: Gemini API not initialized. Please check your API key."
         
-        # Configure the model
-        model = genai.GenerativeModel('gemini-pro')
-        
-        # Prepare context with data if provided
-        context = ""
-        if data:
-            if isinstance(data, dict):
-                context = "Data context:\n"
-                for key, value in data.items():
-                    if isinstance(value, list) and len(value) > 0:
-                        context += f"\n{key} (showing first 5 items):\n"
-                        for i, item in enumerate(value[:5]):
-                            context += f"  {i+1}. {item}\n"
-                    else:
-                        context += f"\n{key}: {value}\n"
-            else:
-                context = f"Data context:\n{str(data)[:1000]}...\n\n"
-        
-        # Combine context and prompt
-        full_prompt = f"{context}\n\nBased on the above data, {prompt}"
+        full_prompt = _build_prompt(prompt, data)
+        
+        # Return a cached response for the same prompt and data context
+        cache_key = _cache_key(full_prompt)
+        cached = _get_cached_response(cache_key)
+        if cached is not None:
+            logger.info(f"Returning cached analysis for prompt: {prompt[:50]}...")
+            return cached
         
         # Generate response
         response = model.generate_content(full_prompt)
+        _cache_response(cache_key, response.text)
         
         logger.info(f"Generated analysis for prompt: {prompt[:50]}...")
         return response.text
     except Exception as e:
         logger.error(f"Failed to analyze with Gemini: {e}")
         return f"Error analyzing data: {str(e)}"
+
+def analyze_data_stream(prompt, data=None):
+    """Analyze data using Gemini API, yielding the response text as it is generated."""
+    try:
+        model = initialize_gemini()
+        if not model:
+            yield "Error: Gemini API not initialized. Please check your API key."
+            return
+        
+        full_prompt = _build_prompt(prompt, data)
+        
+        # Return a cached response for the same prompt and data context
+        cache_key = _cache_key(full_prompt)
+        cached = _get_cached_response(cache_key)
+        if cached is not None:
+            logger.info(f"Returning cached analysis for prompt: {prompt[:50]}...")
+            yield cached
+            return
+        
+        # Stream response chunks as they arrive and cache the full text once complete
+        chunks = []
+        for chunk in model.generate_content(full_prompt, stream=True):
+            chunks.append(chunk.text)
+            yield chunk.text
+        _cache_response(cache_key, ''.join(chunks))
+        
+        logger.info(f"Streamed analysis for prompt: {prompt[:50]}...")
+    except Exception as e:
+        logger.error(f"Failed to analyze with Gemini: {e}")
+        yield f"Error analyzing data: {str(e)}"
@@ -0,0 +1,10 @@
+# Gunicorn configuration: gunicorn -c gunicorn_conf.py app:app
+# Every endpoint spends its time waiting on Shopify, BigQuery or Gemini, so gevent
+# workers serve many concurrent requests per process.
+
+bind = '0.0.0.0:5000'
+worker_class = 'gevent'
+# Pipeline jobs are tracked in process memory (app.JOBS), so status polls must reach
+# the worker that started the job
+workers = 1
+worker_connections = 1000
@@ -1,20 +1,129 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
 from google.cloud import bigquery
+from google.cloud import bigquery_storage_v1
+from google.cloud.bigquery_storage_v1 import types, writer
 from google.cloud.exceptions import NotFound
 from google.oauth2 import service_account
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
 import logging
 import certifi
+import hashlib
 import json
+import orjson
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Let google-cloud-bigquery request short query optimized mode
+# (jobCreationMode=JOB_CREATION_OPTIONAL) for query_and_wait calls
+os.environ.setdefault('QUERY_PREVIEW_ENABLED', 'true')
+
 # Shopify API settings
 SHOPIFY_API_VERSION = '2024-04'
+FIRST_PAGE_LIMIT = 50  # Small first REST page so the first rows arrive quickly
+PAGE_LIMIT = 250  # Max 250 records per page for the rest of the pagination
+BULK_OPERATION_POLL_INTERVAL = 2  # Seconds between bulk operation status checks
+BULK_OPERATION_TIMEOUT = 900  # Seconds to wait for a bulk operation before cancelling it
+BULK_POLL_MAX_RETRIES = 3  # Consecutive failed status checks tolerated before cancelling
+BULK_PAGE_SIZE = 250  # Records per page yielded from bulk operation results
+# Seconds a full REST leaky bucket takes to drain (40 at 2/s on standard plans, 400 at 20/s on Plus)
+SHOPIFY_BUCKET_DRAIN_SECONDS = 20
+SHOPIFY_MAX_RETRIES = 5  # Retries for a throttled (429) request
+
+# Pooled HTTP session so TLS connections are reused across pages and requests
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=20))
+_SESSION.verify = certifi.where()
+
+# Shopify runs only one bulk query per shop at a time
+_BULK_OPERATION_LOCK = threading.Lock()
+
+# GraphQL bulk operation queries for each resource
+CUSTOMERS_BULK_QUERY = """
+{
+  customers {
+    edges {
+      node {
+        id
+        email
+        firstName
+        lastName
+        createdAt
+        updatedAt
+        numberOfOrders
+        amountSpent { amount }
+      }
+    }
+  }
+}
+"""
+
+PRODUCTS_BULK_QUERY = """
+{
+  products {
+    edges {
+      node {
+        id
+        title
+        vendor
+        productType
+        createdAt
+        updatedAt
+        variants {
+          edges {
+            node {
+              id
+              price
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+BULK_OPERATION_RUN_MUTATION = """
+mutation bulkOperationRunQuery($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+BULK_OPERATION_CANCEL_MUTATION = """
+mutation bulkOperationCancel($id: ID!) {
+  bulkOperationCancel(id: $id) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+BULK_OPERATION_STATUS_QUERY = """
+query bulkOperationStatus($id: ID!) {
+  node(id: $id) {
+    ... on BulkOperation { id status errorCode objectCount url }
+  }
+}
+"""
+
+# BigQuery clients keyed by (credentials_path, credentials hash[, project_id]), and datasets/tables
+# already known to exist, so repeated pipeline runs skip the metadata round-trips
+_CLIENT_CACHE = {}
+_WRITE_CLIENT_CACHE = {}
+_KNOWN_DATASETS = set()
+_KNOWN_TABLES = set()
 
 # BigQuery schema for customers table
 CUSTOMERS_BQ_SCHEMA = [
@@ -39,9 +148,36 @@ PRODUCTS_BQ_SCHEMA = [
     bigquery.SchemaField('price', 'FLOAT')
 ]
 
+# Guard on bytes billed for the SELECTs that read data back; LIMIT does not reduce bytes scanned
+FETCH_MAXIMUM_BYTES_BILLED = 10 * 1024 ** 3
+
+# Upserts of up to this many rows are merged inline from a query parameter; larger ones go through staging
+INLINE_MERGE_MAX_ROWS = 10000
+
+# Standard SQL query parameter types for each schema field type
+_QUERY_PARAMETER_TYPES = {
+    'STRING': 'STRING',
+    'TIMESTAMP': 'TIMESTAMP',
+    'INTEGER': 'INT64',
+    'FLOAT': 'FLOAT64'
+}
+
+# Reference point for TIMESTAMP values, which the Storage Write API takes as microseconds since epoch
+_EPOCH = pd.Timestamp(0, tz='UTC')
+
+# Protobuf field types used to serialize rows for the BigQuery Storage Write API
+_PROTO_FIELD_TYPES = {
+    'STRING': descriptor_pb2.FieldDescriptorProto.TYPE_STRING,
+    'TIMESTAMP': descriptor_pb2.FieldDescriptorProto.TYPE_INT64,  # Microseconds since epoch
+    'INTEGER': descriptor_pb2.FieldDescriptorProto.TYPE_INT64,
+    'FLOAT': descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE
+}
+
 def create_dataset(client, dataset_id, project_id):
     """Create a BigQuery dataset if it doesn't exist."""
     dataset_ref = f"{project_id}.{dataset_id}"
+    if dataset_ref in _KNOWN_DATASETS:
+        return
     try:
         client.get_dataset(dataset_ref)
         logger.info(f"Dataset {dataset_id} already exists.")
@@ -50,22 +186,59 @@ def create_dataset(client, dataset_id, project_id):
         dataset.location = "US"  # Set dataset location (change if needed)
         client.create_dataset(dataset, timeout=30)
         logger.info(f"Created dataset {dataset_id}.")
+    _KNOWN_DATASETS.add(dataset_ref)
+
+def _load_credentials(credentials_path):
+    """Read a service account file and return its contents' hash with a loader for its credentials."""
+    with open(credentials_path, 'rb') as credentials_file:
+        content = credentials_file.read()
+    # The file is overwritten in place when BigQuery is reconnected, so cache by content
+    digest = hashlib.sha256(content).hexdigest()
+    return digest, lambda: service_account.Credentials.from_service_account_info(json.loads(content))
 
 def get_bigquery_client(credentials_path, project_id):
-    """Initialize BigQuery client with service account credentials."""
+    """Initialize BigQuery client with service account credentials, reusing a cached client if available."""
     try:
-        credentials = service_account.Credentials.from_service_account_file(credentials_path)
-        client = bigquery.Client(credentials=credentials, project=project_id)
+        digest, load_credentials = _load_credentials(credentials_path)
+        cache_key = (credentials_path, digest, project_id)
+        if cache_key in _CLIENT_CACHE:
+            return _CLIENT_CACHE[cache_key]
+        client = bigquery.Client(credentials=load_credentials(), project=project_id)
+        # Drop clients built from earlier contents of the same file
+        for stale_key in [key for key in _CLIENT_CACHE if key[0] == credentials_path and key[1] != digest]:
+            del _CLIENT_CACHE[stale_key]
+        _CLIENT_CACHE[cache_key] = client
         logger.info("BigQuery client initialized successfully.")
         return client
     except Exception as e:
         logger.error(f"Failed to initialize BigQuery client: {e}")
         raise
 
+def get_bigquery_write_client(credentials_path):
+    """Initialize BigQuery Storage Write client with service account credentials, reusing a cached client if available."""
+    try:
+        digest, load_credentials = _load_credentials(credentials_path)
+        cache_key = (credentials_path, digest)
+        if cache_key in _WRITE_CLIENT_CACHE:
+            return _WRITE_CLIENT_CACHE[cache_key]
+        client = bigquery_storage_v1.BigQueryWriteClient(credentials=load_credentials())
+        # Drop clients built from earlier contents of the same file
+        for stale_key in [key for key in _WRITE_CLIENT_CACHE if key[0] == credentials_path and key[1] != digest]:
+            del _WRITE_CLIENT_CACHE[stale_key]
+        _WRITE_CLIENT_CACHE[cache_key] = client
+        logger.info("BigQuery Storage Write client initialized successfully.")
+        return client
+    except Exception as e:
+        logger.error(f"Failed to initialize BigQuery Storage Write client: {e}")
+        raise
+
 def check_table_exists(client, table_id):
     """Check if a BigQuery table exists."""
+    if table_id in _KNOWN_TABLES:
+        return True
     try:
         client.get_table(table_id)
+        _KNOWN_TABLES.add(table_id)
         return True
     except NotFound:
         return False
@@ -75,95 +248,421 @@ def create_table(client, table_id, schema):
     if not check_table_exists(client, table_id):
         table = bigquery.Table(table_id, schema=schema)
         client.create_table(table)
+        _KNOWN_TABLES.add(table_id)
         logger.info(f"Created table {table_id}.")
 
-def fetch_shopify_data(endpoint, resource_type, api_token, shop_name):
-    """Fetch data from Shopify with pagination."""
+class ShopifyRateLimiter:
+    """Send Shopify Admin API requests, backing off on the call limit header and retrying throttled requests."""
+
+    def __init__(self, drain_seconds=SHOPIFY_BUCKET_DRAIN_SECONDS, max_retries=SHOPIFY_MAX_RETRIES):
+        self.drain_seconds = drain_seconds
+        self.max_retries = max_retries
+
+    def request(self, method, url, **kwargs):
+        """Send a request, retrying 429 responses after Retry-After or an exponential backoff."""
+        for attempt in range(self.max_retries + 1):
+            response = _SESSION.request(method, url, **kwargs)
+            if response.status_code != 429 or attempt == self.max_retries:
+                self._throttle(response)
+                return response
+            delay = max(float(response.headers.get('Retry-After', 0)), 2 ** attempt)
+            logger.warning(f"Shopify rate limit hit, retrying in {delay:.1f}s "
+                           f"(attempt {attempt + 1}/{self.max_retries}).")
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def _throttle(self, response):
+        """Sleep until the bucket has drained to half full once it is more than 80% used."""
+        call_limit = response.headers.get('X-Shopify-Shop-Api-Call-Limit')
+        if not call_limit:
+            return
+        used, maximum = (int(value) for value in call_limit.split('/'))
+        if used / maximum > 0.8:
+            # The leak rate scales with the plan's bucket size, which the header reports
+            leak_rate = maximum / self.drain_seconds
+            delay = (used - maximum * 0.5) / leak_rate
+            logger.info(f"Shopify call limit at {call_limit}, pausing {delay:.1f}s.")
+            time.sleep(delay)
+
+# Shared by all Shopify calls so concurrent resource fetches respect the same bucket
+_SHOPIFY_HTTP = ShopifyRateLimiter()
+
+def _shopify_endpoint(endpoint, api_token, shop_name):
+    """Build the full Shopify Admin API URL and request headers for an endpoint."""
     headers = {
         'X-Shopify-Access-Token': api_token,
         'Content-Type': 'application/json'
     }
-    params = {'limit': 250}  # Max 250 records per page
-    data = []
     base_url = f'https://{shop_name}.myshopify.com/admin/api/{SHOPIFY_API_VERSION}'
-    endpoint = f"{base_url}/{endpoint}"
+    return f"{base_url}/{endpoint}", headers
 
-    while endpoint:
+def _next_page_url(link_header):
+    """Extract the rel="next" URL from a Shopify Link header."""
+    if link_header:
+        links = link_header.split(',')
+        for link in links:
+            if 'rel="next"' in link:
+                return link[link.find('<')+1:link.find('>')]
+    return None
+
+def _with_limit(url, limit):
+    """Return a Shopify page URL with its limit query parameter set to `limit`."""
+    parts = urlsplit(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query) if key != 'limit']
+    query.append(('limit', str(limit)))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+def _fetch_shopify_page(endpoint, headers, params, resource_type):
+    """Fetch a single page from Shopify and return its records and the next page URL."""
+    try:
+        response = _SHOPIFY_HTTP.get(endpoint, headers=headers, params=params)
+        response.raise_for_status()
+        response_data = orjson.loads(response.content)
+        return response_data[resource_type], _next_page_url(response.headers.get('Link'))
+    except requests.RequestException as e:
+        logger.error(f"Failed to fetch Shopify {resource_type}: {e}")
+        raise
+
+def fetch_shopify_pages_prefetch(endpoint, resource_type, api_token, shop_name):
+    """Fetch data from Shopify with pagination, requesting the next page while the current one is consumed."""
+    endpoint, headers = _shopify_endpoint(endpoint, api_token, shop_name)
+    total = 0
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(_fetch_shopify_page, endpoint, headers, {'limit': FIRST_PAGE_LIMIT}, resource_type)
+        while future:
+            page, next_endpoint = future.result()
+            # Request page N+1 before handing page N to the consumer; next page links carry
+            # the first page's limit, so grow it for the remaining pages
+            future = None
+            if next_endpoint:
+                future = executor.submit(_fetch_shopify_page, _with_limit(next_endpoint, PAGE_LIMIT),
+                                         headers, {}, resource_type)
+            total += len(page)
+            logger.info(f"Fetched {len(page)} {resource_type}. Total: {total}")
+            yield page
+
+def _shopify_graphql(query, api_token, shop_name, variables=None):
+    """Run a Shopify Admin GraphQL query and return its data."""
+    endpoint, headers = _shopify_endpoint('graphql.json', api_token, shop_name)
+    response = _SHOPIFY_HTTP.post(endpoint, headers=headers, json={'query': query, 'variables': variables or {}})
+    response.raise_for_status()
+    response_data = orjson.loads(response.content)
+    if response_data.get('errors'):
+        raise RuntimeError(f"Shopify GraphQL errors: {response_data['errors']}")
+    return response_data['data']
+
+def _wait_for_bulk_operation(operation_id, api_token, shop_name):
+    """Poll a bulk operation until it finishes and return it, retrying transient status check failures."""
+    deadline = time.monotonic() + BULK_OPERATION_TIMEOUT
+    poll_errors = 0
+    while True:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Shopify bulk operation {operation_id} did not finish within {BULK_OPERATION_TIMEOUT}s")
+        time.sleep(BULK_OPERATION_POLL_INTERVAL)
         try:
-            response = requests.get(endpoint, headers=headers, params=params, verify=certifi.where())
-            response.raise_for_status()
-            response_data = response.json()
-            data.extend(response_data[resource_type])
-            logger.info(f"Fetched {len(response_data[resource_type])} {resource_type}. Total: {len(data)}")
-            
-            # Handle pagination
-            link_header = response.headers.get('Link')
-            endpoint = None
-            if link_header:
-                links = link_header.split(',')
-                for link in links:
-                    if 'rel="next"' in link:
-                        endpoint = link[link.find('<')+1:link.find('>')]
-                        break
-            params = {}  # Clear params for next page
-        except requests.RequestException as e:
-            logger.error(f"Failed to fetch Shopify {resource_type}: {e}")
+            operation = _shopify_graphql(BULK_OPERATION_STATUS_QUERY, api_token, shop_name, {'id': operation_id})['node']
+        except (requests.RequestException, RuntimeError) as e:
+            poll_errors += 1
+            if poll_errors > BULK_POLL_MAX_RETRIES:
+                raise
+            logger.warning(f"Failed to check Shopify bulk operation {operation_id} "
+                           f"(attempt {poll_errors}/{BULK_POLL_MAX_RETRIES}): {e}")
+            continue
+        poll_errors = 0
+        if operation['status'] in ('COMPLETED', 'FAILED', 'CANCELED', 'EXPIRED'):
+            return operation
+
+def _cancel_bulk_operation(operation_id, api_token, shop_name):
+    """Cancel a bulk operation so it doesn't block later bulk queries; failures are only logged."""
+    try:
+        result = _shopify_graphql(BULK_OPERATION_CANCEL_MUTATION, api_token, shop_name, {'id': operation_id})
+        user_errors = result['bulkOperationCancel']['userErrors']
+        if user_errors:
+            logger.warning(f"Failed to cancel Shopify bulk operation {operation_id}: {user_errors}")
+        else:
+            logger.info(f"Cancelled Shopify bulk operation {operation_id}.")
+    except Exception as e:
+        logger.warning(f"Failed to cancel Shopify bulk operation {operation_id}: {e}")
+
+def run_shopify_bulk_operation(query, api_token, shop_name):
+    """Run a Shopify bulk query and return the URL of its JSONL results, or None if it matched nothing."""
+    with _BULK_OPERATION_LOCK:
+        result = _shopify_graphql(BULK_OPERATION_RUN_MUTATION, api_token, shop_name, {'query': query})
+        result = result['bulkOperationRunQuery']
+        if result['userErrors']:
+            raise RuntimeError(f"Shopify bulk operation rejected: {result['userErrors']}")
+        operation_id = result['bulkOperation']['id']
+        logger.info(f"Started Shopify bulk operation {operation_id}.")
+
+        try:
+            operation = _wait_for_bulk_operation(operation_id, api_token, shop_name)
+        except Exception:
+            # Don't leave the operation running on Shopify, or every later bulk query is rejected
+            _cancel_bulk_operation(operation_id, api_token, shop_name)
             raise
 
-    return data
+    if operation['status'] != 'COMPLETED':
+        raise RuntimeError(f"Shopify bulk operation {operation_id} {operation['status'].lower()}: "
+                           f"{operation['errorCode']}")
+    logger.info(f"Shopify bulk operation {operation_id} completed with {operation['objectCount']} objects.")
+    return operation['url']
+
+def _gid_to_id(gid):
+    """Convert a Shopify GraphQL global ID into the numeric REST ID."""
+    return gid.rsplit('/', 1)[-1]
+
+def _bulk_customer_to_rest(node):
+    """Convert a bulk operation customer node into the REST customer shape."""
+    return {
+        'id': _gid_to_id(node['id']),
+        'email': node.get('email'),
+        'first_name': node.get('firstName'),
+        'last_name': node.get('lastName'),
+        'created_at': node.get('createdAt'),
+        'updated_at': node.get('updatedAt'),
+        'orders_count': node.get('numberOfOrders'),
+        'total_spent': (node.get('amountSpent') or {}).get('amount')
+    }
+
+def _bulk_product_to_rest(node):
+    """Convert a bulk operation product node into the REST product shape; variants are attached later."""
+    return {
+        'id': _gid_to_id(node['id']),
+        'title': node.get('title'),
+        'vendor': node.get('vendor'),
+        'product_type': node.get('productType'),
+        'created_at': node.get('createdAt'),
+        'updated_at': node.get('updatedAt'),
+        'variants': []
+    }
+
+# Bulk query and node converter for each resource
+_BULK_RESOURCES = {
+    'customers': (CUSTOMERS_BULK_QUERY, _bulk_customer_to_rest),
+    'products': (PRODUCTS_BULK_QUERY, _bulk_product_to_rest)
+}
+
+def fetch_shopify_bulk_data(url, resource_type, to_rest):
+    """Stream the JSONL results of a bulk operation, yielding pages of REST-shaped records."""
+    page, records_by_gid = [], {}
+    total = 0
+    try:
+        with _SESSION.get(url, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                node = orjson.loads(line)
+                # Nested connections (product variants) follow their parent as separate lines
+                if '__parentId' in node:
+                    parent = records_by_gid.get(node['__parentId'])
+                    if parent is not None:
+                        parent['variants'].append({'price': node.get('price')})
+                    continue
+                if len(page) >= BULK_PAGE_SIZE:
+                    total += len(page)
+                    logger.info(f"Fetched {len(page)} {resource_type}. Total: {total}")
+                    yield page
+                    page, records_by_gid = [], {}
+                record = to_rest(node)
+                records_by_gid[node['id']] = record
+                page.append(record)
+    except requests.RequestException as e:
+        logger.error(f"Failed to download Shopify bulk {resource_type}: {e}")
+        raise
+
+    if page:
+        total += len(page)
+        logger.info(f"Fetched {len(page)} {resource_type}. Total: {total}")
+        yield page
 
-def transform_customers(customers):
-    """Transform Shopify customers into a DataFrame with default values for missing fields."""
+def fetch_shopify_pages(resource_type, api_token, shop_name):
+    """Fetch pages of a Shopify resource with a bulk operation, falling back to REST pagination."""
+    query, to_rest = _BULK_RESOURCES[resource_type]
     try:
-        data = [{
-            'customer_id': str(customer['id']),
-            'email': customer.get('email', ''),
-            'first_name': customer.get('first_name', ''),
-            'last_name': customer.get('last_name', ''),
-            'created_at': pd.to_datetime(customer.get('created_at', None)),
-            'updated_at': pd.to_datetime(customer.get('updated_at', None)),
-            'orders_count': customer.get('orders_count', 0),
-            'total_spent': float(customer.get('total_spent', 0.0))
-        } for customer in customers]
-        df = pd.DataFrame(data)
+        url = run_shopify_bulk_operation(query, api_token, shop_name)
+    except Exception as e:
+        logger.warning(f"Shopify bulk operation for {resource_type} failed, falling back to REST pagination: {e}")
+        yield from fetch_shopify_pages_prefetch(f'{resource_type}.json', resource_type, api_token, shop_name)
+        return
+    if url:
+        yield from fetch_shopify_bulk_data(url, resource_type, to_rest)
+
+def transform_customers(pages, on_page=None):
+    """Transform pages of Shopify customers into a DataFrame, passing each page's DataFrame to `on_page` if given."""
+    try:
+        frames = []
+        for customers in pages:
+            page_df = pd.DataFrame.from_records(customers, columns=[
+                'id', 'email', 'first_name', 'last_name', 'created_at', 'updated_at', 'orders_count', 'total_spent'
+            ]).rename(columns={'id': 'customer_id'})
+            page_df['customer_id'] = page_df['customer_id'].astype(str)
+            for column in ('created_at', 'updated_at'):
+                page_df[column] = pd.to_datetime(page_df[column], utc=True, format='ISO8601')
+            page_df['orders_count'] = pd.to_numeric(page_df['orders_count'], errors='coerce').fillna(0).astype('int64')
+            page_df['total_spent'] = pd.to_numeric(page_df['total_spent'], errors='coerce').fillna(0.0)
+            if on_page:
+                on_page(page_df)
+            frames.append(page_df)
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
         logger.info(f"Transformed {len(df)} customers into DataFrame.")
         return df
     except Exception as e:
         logger.error(f"Failed to transform customers: {e}")
         raise
 
-def transform_products(products):
-    """Transform Shopify products into a DataFrame with default values for missing fields."""
+def transform_products(pages, on_page=None):
+    """Transform pages of Shopify products into a DataFrame, passing each page's DataFrame to `on_page` if given."""
     try:
-        data = [{
-            'product_id': str(product['id']),
-            'title': product.get('title', ''),
-            'vendor': product.get('vendor', ''),
-            'product_type': product.get('product_type', ''),
-            'created_at': pd.to_datetime(product.get('created_at', None)),
-            'updated_at': pd.to_datetime(product.get('updated_at', None)),
-            'price': float(product['variants'][0]['price']) if product.get('variants') and product['variants'] else 0.0
-        } for product in products]
-        df = pd.DataFrame(data)
+        frames = []
+        for products in pages:
+            page_df = pd.DataFrame.from_records(products, columns=[
+                'id', 'title', 'vendor', 'product_type', 'created_at', 'updated_at'
+            ])
+            # Price of the first variant, flattened column-wise; 0.0 for products without variants
+            with_variants = [product for product in products if product.get('variants')]
+            first_prices = pd.Series(dtype='float64')
+            if with_variants:
+                variants = pd.json_normalize(with_variants, record_path=['variants'], meta=['id'],
+                                             record_prefix='variant_')
+                if 'variant_price' in variants:
+                    first_prices = variants.drop_duplicates('id').set_index('id')['variant_price']
+            page_df['price'] = pd.to_numeric(page_df['id'].map(first_prices), errors='coerce').fillna(0.0)
+            page_df = page_df.rename(columns={'id': 'product_id'})
+            page_df['product_id'] = page_df['product_id'].astype(str)
+            for column in ('created_at', 'updated_at'):
+                page_df[column] = pd.to_datetime(page_df[column], utc=True, format='ISO8601')
+            if on_page:
+                on_page(page_df)
+            frames.append(page_df)
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
         logger.info(f"Transformed {len(df)} products into DataFrame.")
         return df
     except Exception as e:
         logger.error(f"Failed to transform products: {e}")
         raise
 
-def load_to_staging(client, df, staging_table_id, schema):
-    """Load DataFrame to BigQuery staging table."""
-    try:
-        job_config = bigquery.LoadJobConfig(
-            schema=schema,
-            write_disposition='WRITE_TRUNCATE'
+def _row_message_class(schema):
+    """Build a protobuf message class and descriptor matching a BigQuery schema."""
+    descriptor_proto = descriptor_pb2.DescriptorProto(name='Row')
+    for number, field in enumerate(schema, start=1):
+        descriptor_proto.field.add(
+            name=field.name,
+            number=number,
+            type=_PROTO_FIELD_TYPES[field.field_type],
+            label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL
         )
-        job = client.load_table_from_dataframe(df, staging_table_id, job_config=job_config)
-        job.result()  # Wait for job to complete
-        logger.info(f"Loaded {len(df)} rows to staging table {staging_table_id}.")
+    file_proto = descriptor_pb2.FileDescriptorProto(name='row.proto', package='data_connect', syntax='proto2')
+    file_proto.message_type.add().CopyFrom(descriptor_proto)
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    message_class = message_factory.GetMessageClass(pool.FindMessageTypeByName('data_connect.Row'))
+    return message_class, descriptor_proto
+
+def _proto_columns(df, schema):
+    """Convert DataFrame columns to protobuf field values in one pass per column, with None for NULLs."""
+    columns = {}
+    for field in schema:
+        column = df[field.name]
+        if field.field_type == 'TIMESTAMP':
+            column = ((pd.to_datetime(column, utc=True) - _EPOCH) // pd.Timedelta(microseconds=1)).astype('Int64')
+        elif field.field_type == 'INTEGER':
+            column = pd.to_numeric(column).astype('Int64')
+        elif field.field_type == 'FLOAT':
+            column = pd.to_numeric(column).astype('float64')
+        columns[field.name] = column.astype(object).where(column.notna(), None)
+    return columns
+
+def _serialize_rows(df, schema, message_class):
+    """Serialize DataFrame rows into protobuf rows for the Storage Write API."""
+    proto_rows = types.ProtoRows()
+    columns = _proto_columns(df, schema)
+    names = list(columns)
+    for values in zip(*columns.values()):
+        # Unset fields are written as NULL
+        message = message_class(**{name: value for name, value in zip(names, values) if value is not None})
+        proto_rows.serialized_rows.append(message.SerializeToString())
+    return proto_rows
+
+def open_staging_stream(write_client, staging_table_id, schema):
+    """Open an append stream on the default write stream of a BigQuery staging table."""
+    project_id, dataset_id, table_name = staging_table_id.split('.')
+    message_class, descriptor_proto = _row_message_class(schema)
+
+    request_template = types.AppendRowsRequest()
+    request_template.write_stream = f"{write_client.table_path(project_id, dataset_id, table_name)}/streams/_default"
+    proto_schema = types.ProtoSchema()
+    proto_schema.proto_descriptor = descriptor_proto
+    proto_data = types.AppendRowsRequest.ProtoData()
+    proto_data.writer_schema = proto_schema
+    request_template.proto_rows = proto_data
+
+    return writer.AppendRowsStream(write_client, request_template), message_class
+
+def append_to_staging(append_stream, message_class, df, schema):
+    """Append a DataFrame to a staging table stream and return the pending append future."""
+    request = types.AppendRowsRequest()
+    proto_data = types.AppendRowsRequest.ProtoData()
+    proto_data.rows = _serialize_rows(df, schema, message_class)
+    request.proto_rows = proto_data
+    return append_stream.send(request)
+
+def upsert_pages(client, write_client, pages, transform, main_table_id, staging_table_id, schema, key_field):
+    """Transform pages and upsert them into the main table, merging inline or through staging by size."""
+    # Pages are held back until the export grows past INLINE_MERGE_MAX_ROWS; from then on
+    # they are streamed to staging as they arrive and merged from there
+    fields = [field.name for field in schema]
+    seen_pages = []
+    futures = []
+    append_stream = message_class = None
+
+    def on_page(page_df):
+        nonlocal append_stream, message_class
+        if page_df.empty:
+            return
+        if append_stream is not None:
+            futures.append(append_to_staging(append_stream, message_class, page_df, schema))
+            return
+        seen_pages.append(page_df)
+        if sum(len(seen) for seen in seen_pages) > INLINE_MERGE_MAX_ROWS:
+            # Staging is appended to rather than truncated, so start from an empty table in case
+            # an earlier run died before dropping it
+            delete_staging_table(client, staging_table_id)
+            create_table(client, staging_table_id, schema)
+            append_stream, message_class = open_staging_stream(write_client, staging_table_id, schema)
+            for seen in seen_pages:
+                futures.append(append_to_staging(append_stream, message_class, seen, schema))
+            seen_pages.clear()
+
+    try:
+        try:
+            df = transform(pages, on_page=on_page)
+            for future in futures:
+                future.result()  # Wait for every append to be acknowledged
+        finally:
+            if append_stream is not None:
+                append_stream.close()
+
+        if append_stream is not None:
+            logger.info(f"Streamed {len(df)} rows to staging table {staging_table_id}.")
+            merge_upsert(client, main_table_id, staging_table_id, key_field, fields)
+        elif not df.empty:
+            merge_inline(client, main_table_id, df, key_field, schema)
+        return df
     except Exception as e:
-        logger.error(f"Failed to load to staging table: {e}")
+        logger.error(f"Failed to upsert into {main_table_id}: {e}")
         raise
+    finally:
+        # Tidy up staging once the run is over; a run that dies before reaching this point is
+        # covered by the drop in on_page before the stream is opened
+        if append_stream is not None:
+            delete_staging_table(client, staging_table_id)
 
 def merge_upsert(client, main_table_id, staging_table_id, key_field, fields):
     """Perform UPSERT using MERGE statement."""
@@ -188,21 +687,60 @@ def merge_upsert(client, main_table_id, staging_table_id, key_field, fields):
         logger.error(f"Failed to perform UPSERT: {e}")
         raise
 
+def merge_inline(client, main_table_id, df, key_field, schema):
+    """Perform UPSERT using a single MERGE over rows passed as an array query parameter."""
+    fields = [field.name for field in schema]
+    update_fields = ', '.join([f'{field} = S.{field}' for field in fields])
+    insert_fields = ', '.join(fields)
+    insert_values = ', '.join([f'S.{field}' for field in fields])
+    merge_query = f"""
+    MERGE INTO `{main_table_id}` T
+    USING (SELECT * FROM UNNEST(@rows)) S
+    ON T.{key_field} = S.{key_field}
+    WHEN MATCHED THEN
+    UPDATE SET {update_fields}
+    WHEN NOT MATCHED THEN
+    INSERT ({insert_fields})
+    VALUES ({insert_values})
+    """
+    rows = [
+        bigquery.StructQueryParameter(None, *[
+            bigquery.ScalarQueryParameter(
+                field.name,
+                _QUERY_PARAMETER_TYPES[field.field_type],
+                None if pd.isna(record[field.name]) else record[field.name]
+            ) for field in schema
+        ]) for record in df.to_dict('records')
+    ]
+    job_config = bigquery.QueryJobConfig(query_parameters=[bigquery.ArrayQueryParameter('rows', 'STRUCT', rows)])
+    try:
+        query_job = client.query(merge_query, job_config=job_config)
+        query_job.result()  # Wait for job to complete
+        logger.info(f"Completed inline UPSERT of {len(df)} rows to {main_table_id}.")
+    except Exception as e:
+        logger.error(f"Failed to perform inline UPSERT: {e}")
+        raise
+
 def delete_staging_table(client, staging_table_id):
     """Delete the staging table."""
     try:
         client.delete_table(staging_table_id, not_found_ok=True)
+        _KNOWN_TABLES.discard(staging_table_id)
         logger.info(f"Deleted staging table {staging_table_id}.")
     except Exception as e:
         logger.error(f"Failed to delete staging table: {e}")
         raise
 
-def fetch_bigquery_data(client, table_id):
-    """Fetch all data from a BigQuery table."""
+def fetch_bigquery_data(client, table_id, limit=1000):
+    """Fetch up to `limit` rows from a BigQuery table."""
     try:
-        query = f"SELECT * FROM `{table_id}` LIMIT 1000"  # Limit to 1000 rows for API response
-        query_job = client.query(query)
-        results = query_job.result()
+        query = f"SELECT * FROM `{table_id}` LIMIT {int(limit)}"  # Limit to 1000 rows for API response by default
+        job_config = bigquery.QueryJobConfig(
+            use_query_cache=True,
+            maximum_bytes_billed=FETCH_MAXIMUM_BYTES_BILLED
+        )
+        # query_and_wait lets BigQuery skip job creation for short queries
+        results = client.query_and_wait(query, job_config=job_config)
         
         # Convert to list of dicts and handle datetime serialization
         data = []
@@ -219,6 +757,23 @@ def fetch_bigquery_data(client, table_id):
         logger.error(f"Failed to fetch data from {table_id}: {e}")
         raise
 
+def dataframe_to_records(df, limit=1000):
+    """Convert the first rows of a DataFrame to dicts with ISO timestamps and None for missing values."""
+    records = df.head(limit).copy()  # Limit to 1000 rows for API response by default
+    for column in records.select_dtypes(include=['datetime', 'datetimetz']).columns:
+        records[column] = records[column].map(pd.Timestamp.isoformat, na_action='ignore')
+    records = records.astype(object).where(records.notna(), None)
+    return records.to_dict('records')
+
+def fetch_context(client, project_id, dataset_id, limit=10):
+    """Fetch a small sample of customers and products from the main tables for use as analysis context."""
+    customers_data = fetch_bigquery_data(client, f'{project_id}.{dataset_id}.customers', limit)
+    products_data = fetch_bigquery_data(client, f'{project_id}.{dataset_id}.products', limit)
+    return {
+        "customers": customers_data,
+        "products": products_data
+    }
+
 def run_pipeline(shopify_shop_name, shopify_api_token, gcp_project_id, credentials_path, dataset_id='shopify_data'):
     """Run the Shopify to BigQuery pipeline for customers and products."""
     try:
@@ -231,50 +786,42 @@ def run_pipeline(shopify_shop_name, shopify_api_token, gcp_project_id, credentia
         PRODUCTS_MAIN_TABLE_ID = f'{gcp_project_id}.{dataset_id}.products'
         PRODUCTS_STAGING_TABLE_ID = f'{gcp_project_id}.{dataset_id}.products_staging'
 
-        # Initialize BigQuery client
+        # Initialize BigQuery clients
         client = get_bigquery_client(credentials_path, gcp_project_id)
+        write_client = get_bigquery_write_client(credentials_path)
 
         # Create dataset
         create_dataset(client, dataset_id, gcp_project_id)
 
-        # Create main and staging tables for customers
+        # Create main tables; staging tables are only created for exports too large to merge inline
         create_table(client, CUSTOMERS_MAIN_TABLE_ID, CUSTOMERS_BQ_SCHEMA)
-        create_table(client, CUSTOMERS_STAGING_TABLE_ID, CUSTOMERS_BQ_SCHEMA)
-
-        # Create main and staging tables for products
         create_table(client, PRODUCTS_MAIN_TABLE_ID, PRODUCTS_BQ_SCHEMA)
-        create_table(client, PRODUCTS_STAGING_TABLE_ID, PRODUCTS_BQ_SCHEMA)
-
-        # Fetch and transform customers
-        logger.info("Fetching customer data from Shopify...")
-        customers = fetch_shopify_data('customers.json', 'customers', shopify_api_token, shopify_shop_name)
-        if customers:
-            customers_df = transform_customers(customers)
-            load_to_staging(client, customers_df, CUSTOMERS_STAGING_TABLE_ID, CUSTOMERS_BQ_SCHEMA)
-            merge_upsert(client, CUSTOMERS_MAIN_TABLE_ID, CUSTOMERS_STAGING_TABLE_ID, 
-                         'customer_id', ['customer_id', 'email', 'first_name', 'last_name', 
-                                         'created_at', 'updated_at', 'orders_count', 'total_spent'])
-            delete_staging_table(client, CUSTOMERS_STAGING_TABLE_ID)
-        else:
-            logger.info("No customers to process.")
 
-        # Fetch and transform products
-        logger.info("Fetching product data from Shopify...")
-        products = fetch_shopify_data('products.json', 'products', shopify_api_token, shopify_shop_name)
-        if products:
-            products_df = transform_products(products)
-            load_to_staging(client, products_df, PRODUCTS_STAGING_TABLE_ID, PRODUCTS_BQ_SCHEMA)
-            merge_upsert(client, PRODUCTS_MAIN_TABLE_ID, PRODUCTS_STAGING_TABLE_ID, 
-                         'product_id', ['product_id', 'title', 'vendor', 'product_type', 
-                                        'created_at', 'updated_at', 'price'])
-            delete_staging_table(client, PRODUCTS_STAGING_TABLE_ID)
-        else:
+        # Fetch, transform and upsert customers and products concurrently; each page is
+        # transformed while the next one is being fetched
+        logger.info("Fetching customer and product data from Shopify...")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            customers_future = executor.submit(
+                upsert_pages, client, write_client,
+                fetch_shopify_pages('customers', shopify_api_token, shopify_shop_name),
+                transform_customers, CUSTOMERS_MAIN_TABLE_ID, CUSTOMERS_STAGING_TABLE_ID,
+                CUSTOMERS_BQ_SCHEMA, 'customer_id')
+            products_future = executor.submit(
+                upsert_pages, client, write_client,
+                fetch_shopify_pages('products', shopify_api_token, shopify_shop_name),
+                transform_products, PRODUCTS_MAIN_TABLE_ID, PRODUCTS_STAGING_TABLE_ID,
+                PRODUCTS_BQ_SCHEMA, 'product_id')
+            customers_df = customers_future.result()
+            products_df = products_future.result()
+
+        if customers_df.empty:
+            logger.info("No customers to process.")
+        if products_df.empty:
             logger.info("No products to process.")
 
-        # Fetch the final data from BigQuery to return to the frontend
-        logger.info("Fetching processed data from BigQuery...")
-        customers_data = fetch_bigquery_data(client, CUSTOMERS_MAIN_TABLE_ID)
-        products_data = fetch_bigquery_data(client, PRODUCTS_MAIN_TABLE_ID)
+        # Return the rows already in memory rather than querying them back from BigQuery
+        customers_data = dataframe_to_records(customers_df)
+        products_data = dataframe_to_records(products_df)
 
         logger.info("Shopify to BigQuery pipeline completed successfully.")
         return customers_data, products_data